@@ -1,4 +1,5 @@
 import io
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 import pandas as pd
 from rdkit import Chem
@@ -39,21 +40,35 @@ uploaded_sdf_files = st.sidebar.file_uploader(
     "Upload SDF file(s)", type=["sdf"], accept_multiple_files=True
 )
 
+sanitize_mols = st.sidebar.checkbox(
+    "Sanitize molecules (slower)",
+    value=False,
+    help="Runs RDKit sanitization (valence, aromaticity, rings) and writes canonical SMILES. "
+    "Unsanitized molecules are parsed much faster; their SMILES are written as read, "
+    "without canonicalization. Molecules that would fail sanitization are skipped only "
+    "when this is ticked, so the parsed molecule count and exported rows can differ.",
+)
+
 uploaded_pharm_file = st.sidebar.file_uploader(
     "Upload pharmacology Excel file (optional)", type=["xlsx"]
 )
 
 # --- HELPER: LOAD PHARMACOLOGY EXCEL WITH HEADER ROW DETECTION ---
-def load_pharmacology_excel(file) -> pd.DataFrame:
+@st.cache_data(show_spinner=False)
+def load_pharmacology_excel(file_bytes: bytes) -> pd.DataFrame:
     """
     Reads the Excel file where the real header row contains 'Ligand CAS RN'
     and returns a clean dataframe with that row as header.
     Each original column remains a separate column.
+    Cached on the file contents, so widget changes do not re-read the Excel.
     """
-    raw = pd.read_excel(file, header=None)
+    # Column 0 holds 'Ligand CAS RN'; read it as text instead of inferring a dtype
+    raw = pd.read_excel(io.BytesIO(file_bytes), header=None, dtype={0: str})
 
-    # Find the row where column 0 == 'Ligand CAS RN'
-    header_row_idx = raw.index[raw.iloc[:, 0] == "Ligand CAS RN"][0]
+    # Find the first row where column 0 == 'Ligand CAS RN' (idxmax gives 0 if there is none)
+    header_row_idx = raw.iloc[:, 0].eq("Ligand CAS RN").idxmax()
+    if raw.iloc[header_row_idx, 0] != "Ligand CAS RN":
+        raise ValueError("No header row with 'Ligand CAS RN' in the first column was found.")
     new_header = raw.iloc[header_row_idx]
 
     pharm = raw[header_row_idx + 1 :].copy()
@@ -62,23 +77,35 @@ def load_pharmacology_excel(file) -> pd.DataFrame:
 
     return pharm
 
+
+# --- HELPER: LIST AVAILABLE PARAMETERS FOR THE SIDEBAR ---
+@st.cache_data(show_spinner=False)
+def load_pharmacology_parameter_options(file_bytes: bytes) -> list:
+    """
+    Returns the sorted unique values of the 'Parameter' column.
+    Cached separately from the full table, so sidebar reruns only get this
+    short list back instead of a copy of the whole pharmacology dataframe.
+    """
+    pharm = load_pharmacology_excel(file_bytes)
+    if "Parameter" not in pharm.columns:
+        return []
+
+    return (
+        pharm["Parameter"]
+        .dropna()
+        .astype(str)
+        .sort_values()
+        .unique()
+        .tolist()
+    )
+
 # ---------------- SIDEBAR: PARAMETER SELECTION ----------------
 selected_param = None
 pharm_param_options = []
 
 if uploaded_pharm_file is not None:
     try:
-        # We can reuse this later; but here we only need the Parameter column for choices
-        pharm_preview = load_pharmacology_excel(uploaded_pharm_file)
-        if "Parameter" in pharm_preview.columns:
-            pharm_param_options = (
-                pharm_preview["Parameter"]
-                .dropna()
-                .astype(str)
-                .sort_values()
-                .unique()
-                .tolist()
-            )
+        pharm_param_options = load_pharmacology_parameter_options(uploaded_pharm_file.getvalue())
     except Exception as e:
         st.sidebar.warning(f"Could not read pharmacology file yet: {e}")
 
@@ -95,35 +122,180 @@ else:
     st.sidebar.info("Upload pharmacology Excel to select a Parameter (e.g. IC50, MIC, EC50).")
 
 
+# --- HELPER: NORMALIZE CAS NUMBERS FOR MERGING ---
+def normalize_cas(series: pd.Series) -> pd.Series:
+    """
+    Returns CAS numbers as stripped, Arrow-backed strings, so the strip and
+    the CAS merges run on Arrow buffers instead of Python string objects.
+    Missing CAS numbers stay missing (<NA>) instead of becoming 'nan' / 'None'.
+    """
+    return series.astype("string[pyarrow]").str.strip()
+
+
+# --- HELPER: LOAD PHARMACOLOGY RECORDS READY FOR CAS MERGES ---
+def load_pharmacology_records(file_bytes: bytes) -> pd.DataFrame:
+    """
+    Loads the pharmacology table, adds the normalized CAS key (cas_norm) and
+    drops records without a CAS. Such records can never match a ligand, and
+    dropping them keeps missing SDF CAS values from being joined to them.
+    """
+    pharm = load_pharmacology_excel(file_bytes)
+    pharm["cas_norm"] = normalize_cas(pharm["Ligand CAS RN"])
+    return pharm[pharm["cas_norm"].notna()]
+
+
+# --- HELPER: SPLIT PHARMACOLOGY RECORDS BY PARAMETER ---
+PARAMETER_RECORD_COLUMNS = ["cas_norm", "Parameter", "Value"]
+
+
+@st.cache_resource(show_spinner=False)
+def split_pharmacology_by_parameter(file_bytes: bytes) -> dict:
+    """
+    Returns {lower-cased Parameter: cas_norm / Parameter / Value rows with that
+    Parameter}, built from load_pharmacology_records.
+    Built once per file, so changing the selected Parameter is a dictionary
+    lookup instead of a rescan. The tables are shared across reruns
+    (st.cache_resource does not copy), so callers must not modify them.
+    """
+    pharm = load_pharmacology_records(file_bytes)
+
+    # Lower-case with Arrow's vectorized kernel; missing Parameters become <NA> and are dropped
+    param_lower = pharm["Parameter"].astype("string[pyarrow]").str.lower()
+
+    # Only the columns used by the parameter-focused table
+    param_cols = pharm[PARAMETER_RECORD_COLUMNS]
+    return dict(tuple(param_cols.groupby(param_lower, sort=False)))
+
+
 # --- HELPER: AGGREGATE PHARMACOLOGY BY CAS (COLUMN-WISE) ---
 def aggregate_pharmacology_by_cas(pharm_df: pd.DataFrame) -> pd.DataFrame:
     """
     Groups pharmacology records by CAS (cas_norm).
     For each non-CAS column, concatenates unique non-null values as 'v1 | v2 | v3'.
     Each original column stays as a separate column in the aggregated table.
+    If every CAS has a single record, the records are returned as they are.
     """
     # Ensure we have a normalized CAS column
     if "cas_norm" not in pharm_df.columns:
-        pharm_df["cas_norm"] = pharm_df["Ligand CAS RN"].astype(str).str.strip()
+        pharm_df["cas_norm"] = normalize_cas(pharm_df["Ligand CAS RN"])
 
-    def agg_unique(series: pd.Series):
-        vals = series.dropna().astype(str).unique()
-        return " | ".join(vals) if len(vals) > 0 else None
+    cas_pos = pharm_df.columns.get_loc("cas_norm")
+    value_pos = [pos for pos in range(pharm_df.shape[1]) if pos != cas_pos]
 
-    grouped = (
-        pharm_df.groupby("cas_norm", dropna=False)
-        .agg(agg_unique)
-        .reset_index()
-    )
+    # One record per CAS: nothing to combine (reorder by position; labels can repeat)
+    has_cas = pharm_df["cas_norm"].notna()
+    if pharm_df.loc[has_cas, "cas_norm"].is_unique:
+        return pharm_df.loc[has_cas].iloc[:, [cas_pos, *value_pos]].reset_index(drop=True)
+
+    # CAS values whose column is entirely empty stay as missing values
+    cas_keys = pd.Index(pharm_df["cas_norm"].dropna().unique(), name="cas_norm").sort_values()
+
+    # Per column (by position, since header labels can repeat, e.g. blank cells):
+    # drop nulls and repeated (CAS, value) pairs, then join each CAS group
+    agg_cols = []
+    for pos in value_pos:
+        pairs = pd.DataFrame(
+            {"cas_norm": pharm_df["cas_norm"], "value": pharm_df.iloc[:, pos].astype("string")}
+        ).dropna().drop_duplicates()
+        joined = pairs.groupby("cas_norm", sort=False)["value"].agg(" | ".join)
+        agg_cols.append(joined.reindex(cas_keys))
+
+    grouped = pd.concat(agg_cols, axis=1)
+    grouped.columns = pharm_df.columns[value_pos]
+    grouped = grouped.reset_index()
 
     return grouped
 
 
+# --- HELPER: PARSE ONE SDF FILE (SMILES + PROPERTY DICT PER MOLECULE) ---
+def parse_sdf_bytes(sdf_bytes: bytes, sanitize: bool) -> tuple:
+    """
+    Streams the molecules of one SDF file and returns (smiles, prop_dicts),
+    one entry per valid molecule. RDKit Mol objects are not kept.
+    Without sanitization, explicit hydrogens are removed and SMILES are written
+    without canonicalization.
+    """
+    smiles = []
+    prop_dicts = []
+
+    suppl = Chem.ForwardSDMolSupplier(io.BytesIO(sdf_bytes), sanitize=sanitize, removeHs=True)
+    for m in suppl:
+        if m is None:
+            continue
+
+        try:
+            smiles_mol = m
+            if not sanitize:
+                # RDKit ignores removeHs without sanitization; strip explicit Hs here
+                smiles_mol = Chem.RemoveHs(m, sanitize=False)
+            smiles.append(Chem.MolToSmiles(smiles_mol, canonical=sanitize))
+        except Exception:
+            smiles.append(None)
+
+        # Keep property values as the raw SDF strings
+        prop_dicts.append(
+            m.GetPropsAsDict(
+                includePrivate=False, includeComputed=False, autoConvertStrings=False
+            )
+        )
+
+    return smiles, prop_dicts
+
+
+# --- HELPER: PARSE SDF FILES INTO ONE TABLE (SMILES + ALL PROPERTIES) ---
+@st.cache_data(show_spinner=False)
+def parse_sdf_files(sdf_files: tuple, sanitize: bool) -> pd.DataFrame:
+    """
+    Parses a tuple of (file name, file bytes) SDF uploads into one dataframe:
+    ID, SourceFile, SMILES and one column per SDF property.
+    Files are parsed in parallel threads, one file per task.
+    Cached on the uploads and the sanitize flag, so other widget changes
+    do not re-parse the SDF(s).
+    """
+    names = [name for name, _ in sdf_files]
+    with ThreadPoolExecutor() as ex:
+        results = list(
+            ex.map(
+                parse_sdf_bytes,
+                [sdf_bytes for _, sdf_bytes in sdf_files],
+                [sanitize] * len(sdf_files),
+            )
+        )
+
+    # Flatten per-file results in upload order into lists sized up front
+    n_mols = sum(len(file_smiles) for file_smiles, _ in results)
+    file_tags = [None] * n_mols
+    smiles = [None] * n_mols
+    all_prop_dicts = [None] * n_mols
+    seen_props = set()
+
+    start = 0
+    for name, (file_smiles, file_prop_dicts) in zip(names, results):
+        end = start + len(file_smiles)
+        file_tags[start:end] = [name] * len(file_smiles)
+        smiles[start:end] = file_smiles
+        all_prop_dicts[start:end] = file_prop_dicts
+        for props in file_prop_dicts:
+            seen_props.update(props)
+        start = end
+
+    # One column per field; text columns are Arrow-backed strings (buffer + offsets)
+    # rather than one Python object per cell
+    cols = {
+        "ID": list(range(1, n_mols + 1)),
+        "SourceFile": pd.array(file_tags, dtype="string[pyarrow]"),
+        "SMILES": pd.array(smiles, dtype="string[pyarrow]"),
+    }
+    for p in sorted(seen_props):
+        cols[p] = pd.array(
+            [props.get(p) for props in all_prop_dicts], dtype="string[pyarrow]"
+        )
+
+    return pd.DataFrame(cols)
+
+
 # ---------------- MAIN LOGIC ----------------
 if uploaded_sdf_files:
-    all_mols = []
-    file_tags = []
-
     # --- Decide filename prefix from SDF uploads ---
     if len(uploaded_sdf_files) == 1:
         prefix = Path(uploaded_sdf_files[0].name).stem
@@ -133,68 +305,42 @@ if uploaded_sdf_files:
         prefix = f"{first_stem}_and_others"
     prefix = prefix.replace(" ", "_")  # sanitize spaces
 
-    # --- Read molecules from each uploaded SDF ---
-    for up_file in uploaded_sdf_files:
-        sdf_bytes = up_file.read()
-        bio = io.BytesIO(sdf_bytes)
-
-        suppl = Chem.ForwardSDMolSupplier(bio, sanitize=True)
-        mols = [m for m in suppl if m is not None]
-
-        all_mols.extend(mols)
-        file_tags.extend([up_file.name] * len(mols))
+    # --- Parse the uploaded SDF(s) (cached on file names + contents) ---
+    sdf_df = parse_sdf_files(
+        tuple((up_file.name, up_file.getvalue()) for up_file in uploaded_sdf_files),
+        sanitize_mols,
+    )
+    n_mols = len(sdf_df)
 
-    if not all_mols:
+    if n_mols == 0:
         st.error("No valid molecules were found in the uploaded SDF file(s).")
     else:
-        # --- Collect all SDF property names ---
-        all_props = sorted({p for m in all_mols for p in m.GetPropNames()})
-
-        # --- Build SDF dataframe ---
-        sdf_rows = []
-        for idx, (m, src_name) in enumerate(zip(all_mols, file_tags), start=1):
-            row = {"ID": idx, "SourceFile": src_name}
-
-            # SMILES
-            try:
-                row["SMILES"] = Chem.MolToSmiles(m)
-            except Exception:
-                row["SMILES"] = None
-
-            # SDF properties
-            for p in all_props:
-                row[p] = m.GetProp(p) if m.HasProp(p) else None
-
-            sdf_rows.append(row)
-
-        sdf_df = pd.DataFrame(sdf_rows)
-
-        st.success(f"Parsed {len(all_mols)} molecules from {len(uploaded_sdf_files)} SDF file(s).")
+        st.success(f"Parsed {n_mols} molecules from {len(uploaded_sdf_files)} SDF file(s).")
 
         # Normalize SDF CAS for merging
         if "cas.rn" in sdf_df.columns:
-            sdf_df["cas_norm"] = sdf_df["cas.rn"].astype(str).str.strip()
+            sdf_df["cas_norm"] = normalize_cas(sdf_df["cas.rn"])
         else:
-            sdf_df["cas_norm"] = None
+            sdf_df["cas_norm"] = pd.Series(pd.NA, index=sdf_df.index, dtype="string[pyarrow]")
             st.warning("Column 'cas.rn' not found in SDF properties; CAS-based merge may be empty.")
 
-        merged_full_df = sdf_df.copy()
+        merged_full_df = sdf_df  # .merge() below returns a new frame; no copy needed
         param_df_export = None  # will hold the Parameter-focused table
 
         # --- If pharmacology file provided, aggregate by CAS and merge ---
         if uploaded_pharm_file is not None:
-            pharm_df = load_pharmacology_excel(uploaded_pharm_file)
-
-            # Normalize CAS in pharmacology table
-            pharm_df["cas_norm"] = pharm_df["Ligand CAS RN"].astype(str).str.strip()
+            # Normalized CAS, records without a CAS dropped
+            pharm_df = load_pharmacology_records(uploaded_pharm_file.getvalue())
 
             # 1) FULL MERGED TABLE (1 ROW PER LIGAND, PHARMACOLOGY AGGREGATED BY CAS)
-            pharm_agg = aggregate_pharmacology_by_cas(pharm_df)
+            pharm_agg = aggregate_pharmacology_by_cas(pharm_df).set_index("cas_norm")
 
             merged_full_df = merged_full_df.merge(
                 pharm_agg,
-                on="cas_norm",
+                left_on="cas_norm",
+                right_index=True,
                 how="left",
+                sort=False,
                 suffixes=("", "_pharm"),
             )
 
@@ -209,10 +355,10 @@ if uploaded_sdf_files:
             # 2) PARAMETER-FOCUSED TABLE (MULTIPLE ROWS PER LIGAND POSSIBLE)
             if selected_param and "Parameter" in pharm_df.columns and "Value" in pharm_df.columns:
                 # Exact match on the selected parameter (case-insensitive)
-                param_series = pharm_df["Parameter"].astype(str)
-                mask = param_series.str.lower() == selected_param.lower()
-
-                pharm_param = pharm_df[mask].copy()
+                param_groups = split_pharmacology_by_parameter(uploaded_pharm_file.getvalue())
+                pharm_param = param_groups.get(
+                    selected_param.lower(), pd.DataFrame(columns=PARAMETER_RECORD_COLUMNS)
+                )
 
                 if not pharm_param.empty:
                     # Merge parameter pharmacology with key ligand columns
@@ -221,19 +367,19 @@ if uploaded_sdf_files:
                         if col not in sdf_df.columns:
                             sdf_df[col] = None
 
+                    # Inner join on records that have a Value: only ligands with a matching
+                    # record are kept, so no post-merge notna filter is needed
                     param_df_export = sdf_df[base_cols].merge(
-                        pharm_param[["cas_norm", "Parameter", "Value"]],
-                        on="cas_norm",
-                        how="left",
+                        pharm_param.dropna(subset=["Value"]).set_index("cas_norm"),
+                        left_on="cas_norm",
+                        right_index=True,
+                        how="inner",
+                        sort=False,
                     )
 
-                    # Remove helper
-                    param_df_export = param_df_export.drop(columns=["cas_norm"])
-
-                    # Keep only rows where the parameter exists and has a value
+                    # Keep the export columns (drops the cas_norm helper)
                     param_df_export = param_df_export[
-                        param_df_export["Parameter"].notna()
-                        & param_df_export["Value"].notna()
+                        ["SMILES", "cas.index.name", "cas.rn", "Parameter", "Value"]
                     ].reset_index(drop=True)
 
                     st.success(
@@ -254,11 +400,14 @@ if uploaded_sdf_files:
 
         # --- Show preview of full merged table ---
         st.subheader("Full merged table (SDF + aggregated pharmacology)")
-        st.dataframe(merged_full_df.head(50))
+        # Arrow-backed preview: Streamlit sends Arrow to the browser, so no object-column conversion
+        st.dataframe(merged_full_df.head(50).convert_dtypes(dtype_backend="pyarrow"))
         st.write("Rows × Columns:", merged_full_df.shape)
 
         # --- Download full merged table ---
-        full_csv_bytes = merged_full_df.to_csv(index=False).encode("utf-8")
+        full_csv_buf = io.BytesIO()
+        merged_full_df.to_csv(full_csv_buf, index=False, encoding="utf-8")
+        full_csv_bytes = full_csv_buf.getvalue()
         st.download_button(
             label="Download FULL merged CSV",
             data=full_csv_bytes,
@@ -269,10 +418,12 @@ if uploaded_sdf_files:
         # --- If parameter-focused table available, show and offer download ---
         if param_df_export is not None:
             st.subheader(f"'{selected_param}'-focused table")
-            st.dataframe(param_df_export.head(50))
+            st.dataframe(param_df_export.head(50).convert_dtypes(dtype_backend="pyarrow"))
             st.write("Rows × Columns:", param_df_export.shape)
 
-            param_csv_bytes = param_df_export.to_csv(index=False).encode("utf-8")
+            param_csv_buf = io.BytesIO()
+            param_df_export.to_csv(param_csv_buf, index=False, encoding="utf-8")
+            param_csv_bytes = param_csv_buf.getvalue()
             st.download_button(
                 label=f"Download '{selected_param}'-focused CSV",
                 data=param_csv_bytes,